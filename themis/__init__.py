@@ -1 +1,4 @@
 from .themis import Themis
+from .scheduler import Scheduler, PipelineScheduler
+from .cost_model import CostModel
+from .admission import AdmissionController
@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import threading
+import itertools
+
+from nxtools import *
+
+from .audio_analysis import CHUNK_SIZE
+
+__all__ = ["estimate_resources", "AdmissionController", "JobCgroup"]
+
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Rough model of ffmpeg memory usage
+PROCESS_OVERHEAD = 150 * MB   # Per ffmpeg process (codecs, buffers, libraries)
+DECODER_FRAMES = 32           # Reference frames and frame threads of the decoder
+ENCODER_FRAMES = {            # Lookahead, B-frames and frame threads of the encoder
+        "libx264" : 80,
+        "libx265" : 100,
+        "mpeg2video" : 24,
+    }
+DEFAULT_ENCODER_FRAMES = 16
+PIPE_FRAMES = 4               # Raw frames in flight between decoder and encoder when reclocking
+ANALYSIS_TEMP_ARRAYS = 3      # Chunk-sized float32 arrays per track during audio analysis
+
+
+def bytes_per_pixel(pixel_format):
+    if pixel_format.startswith("yuv420") or pixel_format.startswith("nv12"):
+        bpp = 1.5
+    elif pixel_format.startswith("yuv422"):
+        bpp = 2
+    elif pixel_format.startswith("rgba") or pixel_format.startswith("bgra") or pixel_format.startswith("argb"):
+        bpp = 4
+    else:
+        bpp = 3
+    if any(depth in pixel_format for depth in ["p10", "p12", "p16", "48", "64"]):
+        bpp *= 2
+    return bpp
+
+
+def estimate_resources(transcoder):
+    """
+    Returns estimated peak memory and scratch disk usage (bytes)
+    of the job as a dict with "memory" and "scratch" keys.
+    """
+    meta = transcoder.meta
+    settings = transcoder.settings
+    encode_method = getattr(transcoder, "encode_method", "direct")
+
+    source_frame = meta["width"] * meta["height"] * bytes_per_pixel(meta["pixel_format"])
+    target_frame = settings["width"] * settings["height"] * bytes_per_pixel(settings["pixel_format"])
+    encoder_frames = ENCODER_FRAMES.get(settings["video_codec"], DEFAULT_ENCODER_FRAMES)
+
+    memory = source_frame * DECODER_FRAMES + target_frame * encoder_frames
+    if encode_method == "reclock":
+        # Separate decoder and encoder processes connected by a rawvideo pipe
+        memory += 2 * PROCESS_OVERHEAD + target_frame * (PIPE_FRAMES + DECODER_FRAMES)
+    else:
+        memory += PROCESS_OVERHEAD
+
+    # Extracted (and reclocked) 16bit PCM audio
+    scratch = 0
+    max_channels = 0
+    for track in transcoder.audio_tracks:
+        channels = 2 if settings.get("to_stereo", True) else track.get("channels", 2)
+        max_channels = max(max_channels, channels)
+        scratch += meta["duration"] * settings.get("audio_sample_rate", 48000) * channels * 2
+    if encode_method == "reclock":
+        scratch *= 2
+
+    if settings.get("strip_tracks") == 3 and len(transcoder.audio_tracks) > 1:
+        # float64 downmix of all tracks and float32 temporary arrays of the track being analyzed.
+        # Audio is analyzed before encoding starts, so it does not add up with the encoder
+        analysis = CHUNK_SIZE * (8 * len(transcoder.audio_tracks) + 4 * ANALYSIS_TEMP_ARRAYS * max_channels)
+        memory = max(memory, analysis)
+
+    return {
+            "memory" : int(memory),
+            "scratch" : int(scratch)
+        }
+
+
+def get_memory_info():
+    """Returns (total, available) memory in bytes"""
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            info[key] = int(value.split()[0]) * 1024
+    return info["MemTotal"], info.get("MemAvailable", info["MemFree"])
+
+
+
+class JobCgroup(object):
+    """
+    cgroup v2 group with a memory limit for child processes of a single job.
+    Use JobCgroup.create, which returns None if cgroups are not available.
+    """
+    root = "/sys/fs/cgroup/themis"
+    _seq = itertools.count()
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def create(cls, memory_max):
+        path = None
+        try:
+            if not os.path.isdir(cls.root):
+                os.makedirs(cls.root)
+                with open(os.path.join(cls.root, "cgroup.subtree_control"), "w") as f:
+                    f.write("+memory")
+            job_path = os.path.join(cls.root, "job-{}-{}".format(os.getpid(), next(cls._seq)))
+            os.mkdir(job_path)
+            path = job_path
+            with open(os.path.join(path, "memory.max"), "w") as f:
+                f.write(str(int(memory_max)))
+        except (IOError, OSError):
+            logging.debug("cgroups are not available. Job memory will not be limited")
+            if path:
+                cls(path).remove()
+            return None
+        return cls(path)
+
+    def add(self, pid):
+        try:
+            with open(os.path.join(self.path, "cgroup.procs"), "w") as f:
+                f.write(str(pid))
+        except (IOError, OSError):
+            logging.warning("Unable to move process {} to {}".format(pid, self.path))
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except (IOError, OSError):
+            logging.warning("Unable to remove {}".format(self.path))
+
+
+
+class AdmissionController(object):
+    """
+    Admits new jobs only while the host stays under configured headroom.
+
+    A job is admitted if its estimated memory fits both into the memory currently
+    available and into the total memory not reserved by other running jobs, and if
+    its estimated scratch usage fits into free space of the scratch directory.
+    Memory of each admitted job is limited using cgroups where available.
+    """
+    def __init__(self, **kwargs):
+        self.settings = self.defaults
+        self.settings.update(kwargs)
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    @property
+    def defaults(self):
+        return {
+            "memory_headroom" : 2 * GB,     # Memory which is always kept free
+            "scratch_headroom" : 10 * GB,   # Scratch space which is always kept free
+            "scratch_dir" : tempfile.gettempdir(),
+            "use_cgroups" : True,
+            "memory_limit_factor" : 1.5,   # cgroup memory limit relative to the estimate
+        }
+
+    @property
+    def reserved(self):
+        memory = sum([reservation["memory"] for reservation in self.reservations.values()])
+        scratch = sum([reservation["scratch"] for reservation in self.reservations.values()])
+        return memory, scratch
+
+    def can_admit(self, transcoder):
+        estimate = estimate_resources(transcoder)
+        with self.lock:
+            if not self.reservations:
+                # Never block the only job
+                return True
+            reserved_memory, reserved_scratch = self.reserved
+
+        try:
+            total_memory, available_memory = get_memory_info()
+            free_scratch = shutil.disk_usage(self["scratch_dir"]).free
+        except (IOError, OSError):
+            log_traceback("Unable to get host resources")
+            return True
+
+        if estimate["memory"] > available_memory - self["memory_headroom"]:
+            reason = "available memory"
+        elif estimate["memory"] + reserved_memory > total_memory - self["memory_headroom"]:
+            reason = "memory reserved by running jobs"
+        elif estimate["scratch"] + reserved_scratch > free_scratch - self["scratch_headroom"]:
+            reason = "scratch space"
+        else:
+            return True
+        logging.debug("{}: Not enough {} (needs {:.0f}MB memory, {:.0f}MB scratch)".format(
+                transcoder.friendly_name,
+                reason,
+                estimate["memory"] / float(MB),
+                estimate["scratch"] / float(MB)
+            ))
+        return False
+
+    def admit(self, transcoder):
+        estimate = estimate_resources(transcoder)
+        with self.lock:
+            self.reservations[id(transcoder)] = estimate
+        if self["use_cgroups"]:
+            transcoder.cgroup = JobCgroup.create(estimate["memory"] * self["memory_limit_factor"])
+
+    def release(self, transcoder):
+        with self.lock:
+            self.reservations.pop(id(transcoder), None)
+        if getattr(transcoder, "cgroup", None):
+            transcoder.cgroup.remove()
+            transcoder.cgroup = None
@@ -0,0 +1,130 @@
+import os
+import math
+import struct
+
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+__all__ = ["has_numpy", "open_wav", "analyze_tracks", "CHUNK_SIZE"]
+
+CHUNK_SIZE = 48000 * 10   # Samples per track analyzed at once
+
+
+def open_wav(path):
+    """
+    Returns memory-mapped samples of 16bit PCM WAV file
+    as (num_samples, num_channels) int16 array.
+    """
+    with open(path, "rb") as f:
+        riff, size, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise ValueError("{} is not a WAV file".format(path))
+        channels = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("{} has no data chunk".format(path))
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                audio_format, channels = struct.unpack("<HH", fmt[:4])
+                bits = struct.unpack("<H", fmt[14:16])[0]
+                if bits != 16:
+                    raise ValueError("{} is not 16bit PCM".format(path))
+            elif chunk_id == b"data":
+                offset = f.tell()
+                break
+            else:
+                f.seek(chunk_size + (chunk_size % 2), 1)
+
+    if not channels:
+        raise ValueError("{} has no fmt chunk".format(path))
+
+    # Data chunk size is not reliable for large or unfinished files
+    num_samples = (os.path.getsize(path) - offset) // (2 * channels)
+    if not num_samples:
+        return np.zeros((0, channels), dtype="<i2")
+    return np.memmap(path, dtype="<i2", mode="r", offset=offset, shape=(num_samples, channels))
+
+
+def to_db(value):
+    if value <= 0:
+        return -math.inf
+    return 20 * math.log10(value)
+
+
+def analyze_tracks(paths, silence_threshold=-60, block_size=4800, chunk_size=CHUNK_SIZE):
+    """
+    Analyzes extracted audio tracks.
+
+    Returns list of dicts (one per track) with rms and peak (dBFS),
+    silence_ratio (share of blocks quieter than silence_threshold) and
+    correlation (list of Pearson correlation coefficients with all tracks,
+    computed on channel downmix).
+
+    Tracks are processed in chunks, so memory usage does not depend on
+    the duration. Samples of each track are converted to float32, while
+    channel downmixes used for the correlation (8 bytes per sample of all
+    tracks in a chunk) and all sums are float64.
+    """
+    tracks = [open_wav(path) for path in paths]
+    num_tracks = len(tracks)
+    length = min([len(track) for track in tracks] or [0])
+    chunk_size -= chunk_size % block_size
+    silence_level = 10 ** (silence_threshold / 20.0) * 32768
+
+    sum_sq = np.zeros(num_tracks)
+    peak = np.zeros(num_tracks)
+    silent_blocks = np.zeros(num_tracks)
+    total_blocks = 0
+
+    # Accumulators for correlation matrix
+    sum_x = np.zeros(num_tracks)
+    sum_xy = np.zeros((num_tracks, num_tracks))
+
+    for start in range(0, length, chunk_size):
+        end = min(start + chunk_size, length)
+        num_blocks = (end - start) // block_size
+        mono = np.empty((num_tracks, end - start), dtype=np.float64)
+        for i, track in enumerate(tracks):
+            chunk = np.asarray(track[start:end], dtype=np.float32)
+            sum_sq[i] += np.sum(chunk * chunk, dtype=np.float64) / chunk.shape[1]
+            peak[i] = max(peak[i], np.max(np.abs(chunk)))
+            mono[i] = chunk.mean(axis=1)
+            if num_blocks:
+                blocks = chunk[:num_blocks * block_size].reshape(num_blocks, -1)
+                block_rms = np.sqrt(np.mean(blocks * blocks, axis=1, dtype=np.float64))
+                silent_blocks[i] += np.count_nonzero(block_rms < silence_level)
+        total_blocks += num_blocks
+        sum_x += mono.sum(axis=1)
+        sum_xy += mono.dot(mono.T)
+
+    result = []
+    if not length:
+        for i in range(num_tracks):
+            result.append({
+                    "rms" : -math.inf,
+                    "peak" : -math.inf,
+                    "silence_ratio" : 1.0,
+                    "correlation" : [0.0] * num_tracks
+                })
+        return result
+
+    mean = sum_x / length
+    cov = sum_xy / length - np.outer(mean, mean)
+    std = np.sqrt(np.maximum(np.diag(cov), 0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = cov / np.outer(std, std)
+    correlation[~np.isfinite(correlation)] = 0
+
+    for i in range(num_tracks):
+        result.append({
+                "rms" : to_db(math.sqrt(sum_sq[i] / length) / 32768),
+                "peak" : to_db(peak[i] / 32768),
+                "silence_ratio" : float(silent_blocks[i]) / total_blocks if total_blocks else 1.0,
+                "correlation" : [float(c) for c in correlation[i]]
+            })
+    return result
@@ -1,6 +1,8 @@
 from __future__ import print_function
 
 import time
+import signal
+import subprocess
 
 from nxtools import *
 from nxtools.media import *
@@ -69,6 +71,7 @@ def probe(source_path, progress_handler=False):
             meta["width"] = stream["width"]
             meta["height"] = stream["height"]
             meta["video_index"] = stream["index"]
+            meta["field_order"] = stream.get("field_order", "unknown")
 
             for key in ["color_range"]:
                 if key in stream:
@@ -133,18 +136,35 @@ class ProcessResult(object):
         return not self.is_success
 
 
+def get_temp_path(output_path):
+    """Hidden path the output is written to before it is complete"""
+    dir_name, file_name = os.path.split(output_path)
+    base_name, ext = os.path.splitext(file_name)
+    return os.path.join(dir_name, ".{}.part{}".format(base_name, ext))
+
+
 #
 # Main class
 #
 
 
 class BaseTranscoder(object):
+    stages = ["process"]
+
     def __init__(self, input_path, **kwargs):
         self.input_path = input_path
         self.settings = self.defaults
         self.settings.update(kwargs)
-        self.meta = probe(input_path)
+        self.meta = self.probe_source()
         self.last_progress_time = time.time()
+        self.output_checksum = False
+        self.procs = []
+        self.cgroup = None
+        self.is_paused = False
+        self.paused_time = 0
+        self.proc_time = 0
+        self.start_time = False
+        self.stage_start_time = False
         if self.meta:
             self.is_ok = True
         else:
@@ -157,6 +177,42 @@ class BaseTranscoder(object):
     def __len__(self):
         return self.is_ok
 
+    def probe_source(self):
+        """
+        Returns source metadata. In follow mode, the source may still be written,
+        so probing is retried until headers are available or the file stops growing.
+        """
+        if not self.settings.get("follow", False):
+            return probe(self.input_path)
+
+        last_size = -1
+        last_change = time.time()
+        while True:
+            try:
+                meta = probe(self.input_path)
+            except Exception:
+                meta = False
+            if meta:
+                return meta
+            size = os.path.getsize(self.input_path) if os.path.exists(self.input_path) else 0
+            if size != last_size:
+                last_size = size
+                last_change = time.time()
+            elif time.time() - last_change > self.settings["follow_timeout"]:
+                return False
+            time.sleep(1)
+
+    @property
+    def input_options(self):
+        """Input options for ffmpeg processes reading the source file"""
+        if not self.settings.get("follow", False):
+            return []
+        # Keep reading at the end of the file until it stops growing
+        return [
+                ["follow", 1],
+                ["rw_timeout", int(self.settings["follow_timeout"] * 1000000)]
+            ]
+
     @property
     def defaults(self):
         return {}
@@ -184,6 +240,41 @@ class BaseTranscoder(object):
         #TODO: mark-in / out
         return self.meta["duration"]
 
+    #
+    # Cost prediction
+    #
+
+    @property
+    def cost_key(self):
+        """Job properties affecting processing speed. See CostModel.key_fields"""
+        return None
+
+    @property
+    def predicted_time(self):
+        """Expected processing time (seconds) or None if unknown"""
+        cost_model = self.settings.get("cost_model", False)
+        if not (cost_model and self.cost_key):
+            return None
+        return cost_model.predict(self.cost_key, self.duration)
+
+    @property
+    def elapsed_time(self):
+        """Processing time so far. Time spent paused or waiting between stages is not counted"""
+        elapsed_time = self.proc_time - self.paused_time
+        if self.stage_start_time:
+            elapsed_time += time.time() - self.stage_start_time
+        if self.is_paused:
+            elapsed_time -= time.time() - self.pause_start_time
+        return max(0, elapsed_time)
+
+    @property
+    def eta(self):
+        """Expected remaining processing time (seconds) or None if unknown"""
+        predicted_time = self.predicted_time
+        if predicted_time is None:
+            return None
+        return max(0, predicted_time - self.elapsed_time)
+
     #
     # Paths and names
     #
@@ -216,6 +307,72 @@ class BaseTranscoder(object):
                     )
                 )
 
+    @property
+    def temp_output_path(self):
+        """Output is written here and renamed to output_path once complete"""
+        if self.settings.get("growing", False):
+            # Growing files must be readable at their final location
+            return self.output_path
+        return get_temp_path(self.output_path)
+
+    @property
+    def checksum_path(self):
+        """Stream hash of encoded packets ("ALGO=hexdigest"), not a file checksum"""
+        return self.output_path + ".streamhash"
+
+    @property
+    def temp_checksum_path(self):
+        return self.temp_output_path + ".streamhash"
+
+    #
+    # Child processes
+    #
+
+    def register_process(self, proc):
+        """
+        Registers running child process (Popen, FFMPEG or Sox instance),
+        so the job can be paused, resumed, reniced and memory limited by the scheduler.
+        """
+        proc = getattr(proc, "proc", proc)
+        self.procs = [p for p in self.procs if p.poll() is None]
+        self.procs.append(proc)
+        if self.cgroup:
+            self.cgroup.add(proc.pid)
+        if self.settings.get("nice", False):
+            self.renice(proc)
+        if self.is_paused:
+            self.signal_process(proc, signal.SIGSTOP)
+
+    def renice(self, proc):
+        try:
+            os.setpriority(os.PRIO_PROCESS, proc.pid, self.settings["nice"])
+            subprocess.call(["ionice", "-c", "3", "-p", str(proc.pid)])
+        except Exception:
+            logging.warning("{}: Unable to renice process {}".format(self.friendly_name, proc.pid))
+
+    def signal_process(self, proc, sig):
+        if proc.poll() is not None:
+            return
+        try:
+            os.kill(proc.pid, sig)
+        except OSError:
+            pass
+
+    def pause(self):
+        """Stops all child processes. No work is lost, use resume() to continue"""
+        self.is_paused = True
+        self.pause_start_time = time.time()
+        for proc in self.procs:
+            self.signal_process(proc, signal.SIGSTOP)
+        logging.info("{}: Paused".format(self.friendly_name))
+
+    def resume(self):
+        self.is_paused = False
+        self.paused_time += time.time() - self.pause_start_time
+        for proc in self.procs:
+            self.signal_process(proc, signal.SIGCONT)
+        logging.info("{}: Resumed".format(self.friendly_name))
+
     #
     # Processing
     #
@@ -234,10 +391,12 @@ class BaseTranscoder(object):
 
     def progress_handler(self, progress):
         if time.time() - self.last_progress_time > 3:
-            logging.debug("{}: {} ({:.02f}% done)".format(
+            eta = self.eta
+            logging.debug("{}: {} ({:.02f}% done{})".format(
                     self.friendly_name,
                     self.status,
-                    progress
+                    progress,
+                    ", ETA {}".format(s2words(eta)) if eta is not None else ""
                 ))
             self.last_progress_time = time.time()
 
@@ -246,22 +405,33 @@ class BaseTranscoder(object):
         logging.warning("Nothing to do. You must override process method")
 
 
-    def start(self, **kwargs):
+    def begin(self, **kwargs):
         self.set_status("Starting {} transcoder".format(self.__class__.__name__), level="info")
-        start_time = time.time()
         self.settings.update(kwargs)
+        self.start_time = time.time()
+        self.paused_time = 0
+        self.proc_time = 0
+
+
+    def run_stage(self, stage):
+        """
+        Runs single processing stage (name of the method). Stages may be run
+        by different workers, time spent waiting between them is not counted.
+        """
+        self.stage_start_time = time.time()
         try:
-            result = self.process()
+            return getattr(self, stage)()
         except KeyboardInterrupt:
-            print ()
-            self.set_status("Aborted", level="warning")
-            self.fail_clean_up()
-            return False
-
+            raise
         except Exception:
             log_traceback("Unhandled exception occured during transcoding")
-            result = False
+            return False
+        finally:
+            self.proc_time += time.time() - self.stage_start_time
+            self.stage_start_time = False
+
 
+    def finish(self, result):
         if not result:
             self.fail_clean_up()
             self.set_status("Failed", level="error")
@@ -269,9 +439,10 @@ class BaseTranscoder(object):
 
         # Final report
 
-        end_time = time.time()
-        proc_time = end_time - start_time
+        proc_time = self.proc_time - self.paused_time
         speed = self.duration / proc_time
+        if self.settings.get("cost_model", False) and self.cost_key:
+            self.settings["cost_model"].record(self.cost_key, self.duration, proc_time)
         logging.info(
             "{}: transcoding {:.2f}s long video finished in {} ({:.2f}x realtime)".format(
                 self.friendly_name,
@@ -284,3 +455,15 @@ class BaseTranscoder(object):
         return True
 
 
+    def start(self, **kwargs):
+        self.begin(**kwargs)
+        try:
+            result = self.run_stage("process")
+        except KeyboardInterrupt:
+            print ()
+            self.set_status("Aborted", level="warning")
+            self.fail_clean_up()
+            return False
+        return self.finish(result)
+
+
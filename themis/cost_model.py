@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import socket
+import threading
+
+from nxtools import *
+
+__all__ = ["CostModel"]
+
+
+class CostModel(object):
+    """
+    Per-host history of transcoding speeds used to predict processing time.
+
+    Each finished job is stored with its cost key (output profile, encode method,
+    resolution, source codec and frame rate). Predictions use the median
+    speed of the most specific key with enough history, falling back to
+    coarser keys (fewer leading fields) when the exact combination is unknown.
+    Fields are ordered from the most speed-determining, so coarse keys
+    keep the output profile.
+    """
+    key_fields = ["output_profile", "encode_method", "resolution", "video_codec", "frame_rate"]
+
+    def __init__(self, path=None, max_records=50, min_records=1):
+        if path is None:
+            path = os.path.join(
+                    os.path.expanduser("~"),
+                    ".themis",
+                    "history-{}.json".format(socket.gethostname())
+                )
+        self.path = path
+        self.max_records = max_records
+        self.min_records = min_records
+        self.lock = threading.Lock()
+        self.history = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            self.history = json.load(open(self.path))
+        except Exception:
+            log_traceback("Unable to load job history from {}".format(self.path))
+
+    def save(self):
+        dir_name = os.path.split(self.path)[0]
+        if dir_name and not os.path.exists(dir_name):
+            os.makedirs(dir_name)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.history, f)
+        os.rename(temp_path, self.path)
+
+    @staticmethod
+    def serialize_key(cost_key, depth):
+        return "|".join([str(cost_key[field]) for field in CostModel.key_fields[:depth]])
+
+
+    def record(self, cost_key, duration, proc_time):
+        """Stores speed (realtime ratio) of finished job under all key levels"""
+        if not (duration and proc_time):
+            return
+        speed = duration / proc_time
+        with self.lock:
+            for depth in range(len(self.key_fields) + 1):
+                records = self.history.setdefault(self.serialize_key(cost_key, depth), [])
+                records.append([time.time(), speed])
+                del records[:-self.max_records]
+            try:
+                self.save()
+            except Exception:
+                log_traceback("Unable to save job history to {}".format(self.path))
+
+    def predict_speed(self, cost_key):
+        """Returns expected realtime ratio or None if there is no history"""
+        with self.lock:
+            for depth in range(len(self.key_fields), -1, -1):
+                records = self.history.get(self.serialize_key(cost_key, depth), [])
+                if len(records) >= self.min_records:
+                    speeds = sorted([speed for tstamp, speed in records])
+                    return speeds[len(speeds) // 2]
+        return None
+
+    def predict(self, cost_key, duration):
+        """Returns expected processing time in seconds or None"""
+        speed = self.predict_speed(cost_key)
+        if not speed:
+            return None
+        return duration / speed
@@ -6,9 +6,62 @@ from nxtools import *
 from nxtools.media import *
 
 from .sox import Sox
-from .output_profile import get_output_profile
+from .output_profile import get_output_profile, get_container_options
+
+__all__ = ["reclock_audio", "encode"]
+
+
+def escape_tee_path(path):
+    """Escapes special characters of the tee slave filename (see av_escape)"""
+    for char in ["\\", "'", "|"]:
+        path = path.replace(char, "\\" + char)
+    return path
+
+
+def get_tee_output(parent):
+    """
+    Returns tee muxer output specification which writes the output file
+    and its stream hash in a single pass, so the output does not need to be
+    read again after encoding. Note that the hash muxer hashes encoded
+    packets of all streams, not bytes of the output file.
+    """
+    muxer_options = ["f={}".format(parent.settings["container"])]
+    for key, value in get_container_options(**parent.settings):
+        muxer_options.append("{}={}".format(key, value))
+    return "[{}]{}|[f=hash:hash={}]{}".format(
+            ":".join(muxer_options),
+            escape_tee_path(parent.temp_output_path),
+            parent.settings["checksum"],
+            escape_tee_path(parent.temp_checksum_path)
+        )
+
+
+def reclock_audio(parent):
+    """Time-stretches extracted audio tracks to match reclocked video"""
+    if not parent.reclock_ratio:
+        return True
+
+    for i, track in enumerate(parent.audio_tracks):
+        parent.set_status("Reclocking audio {} of {}".format(
+            i+1,
+            len(parent.audio_tracks),
+            ))
+        f_in = track.source_audio_path
+        f_out = track.final_audio_path = get_temp("wav")
+        cmd = [
+                f_in,
+                "-r", parent.settings.get("audio_sample_rate", 48000),
+                f_out
+            ]
+        cmd.extend(["tempo", parent.reclock_ratio])
+        sox = Sox(*cmd)
+        sox.start(check_output=False)
+        parent.register_process(sox)
+        if sox.check_output(handler=parent.progress_handler):
+            logging.error("Reclocking failed with following error:\n\n{}\n\n".format(indent(sox.error)))
+            return False
+    return True
 
-__all__ = ["encode"]
 
 def encode(parent):
     source_duration = parent.meta["num_frames"] / parent.meta["frame_rate"]
@@ -17,11 +70,15 @@ def encode(parent):
     if parent.reclock_ratio:
         target_duration /= parent.reclock_ratio
         encode_method = "reclock"
-        source_input_format = [["t", source_duration]]
+        source_input_format = parent.input_options + [["t", source_duration]]
         source_format = [
                     ["an"],
                     ["map", "0:{}".format(parent.meta["video_index"])],
                     ["filter:v", parent.filters],
+                ]
+        if parent.settings.get("filter_threads", False):
+            source_format.append(["filter_threads", parent.settings["filter_threads"]])
+        source_format += [
                     ["pix_fmt", parent.settings["pixel_format"]],
                     ["f", "rawvideo"],
                 ]
@@ -35,36 +92,38 @@ def encode(parent):
 
     else:
         encode_method = "direct"
-        input_format = [["t", source_duration]]
+        input_format = parent.input_options
+        if not parent.follows_source:
+            # Followed source is read until it stops growing
+            input_format.append(["t", source_duration])
         output_format = []
         track_mapping = [["map", "0:{}".format(parent.meta["video_index"])]]
 
 
 
     for i, track in enumerate(parent.audio_tracks):
-        if encode_method == "reclock":
-            parent.set_status("Reclocking audio {} of {}".format(
-                i+1,
-                len(parent.audio_tracks),
-                ))
-            f_in = track.source_audio_path
-            f_out = track.final_audio_path = get_temp("wav")
-            cmd = [
-                    f_in,
-                    "-r", parent.settings.get("audio_sample_rate", 48000),
-                    f_out
-                ]
-            cmd.extend(["tempo", parent.reclock_ratio])
-            sox = Sox(*cmd)
-            result = sox.start(handler=parent.progress_handler)
-
-        track_mapping.append(["map", "{}:{}".format(i+1, 0)])
+        if parent.follows_source:
+            # Audio is read from the growing source together with video
+            track_mapping.append(["map", "0:{}".format(track.id)])
+            if parent["to_stereo"]:
+                track_mapping.append(["ac:{}".format(i+1), 2])
+        else:
+            track_mapping.append(["map", "{}:{}".format(i+1, 0)])
+            output_format.append(["i", track.final_audio_path])
         track_mapping.append(["filter:{}".format(i+1), "apad"])
         if track.get("tags", {}).get("language", False):
             track_mapping.append(["metadata:s:{}".format(i+1), "language={}".format(track["tags"]["language"])])
-        output_format.append(["i", track.final_audio_path])
 
 
+    def progress_handler(frames):
+        if frames > parent.meta["num_frames"]:
+            # Followed source is longer than it was when probed
+            parent.meta["num_frames"] = frames
+        progress = float(frames) / parent.meta["num_frames"]
+        parent.progress_handler(progress * 100)
+        if parent.settings.get("growing", False):
+            parent.update_readiness(float(frames) / parent.meta["frame_rate"] / (parent.reclock_ratio or 1))
+
     parent.set_status("Transcoding")
     logging.debug("Source duration:", source_duration)
 
@@ -74,10 +133,13 @@ def encode(parent):
         output_format.append(["filter:v", parent.filters])
 
     output_format.extend(get_output_profile(**parent.settings))
+    if parent.settings.get("filter_threads", False) and encode_method == "direct":
+        output_format.append(["filter_threads", parent.settings["filter_threads"]])
 
     if encode_method == "reclock":
         dec = FFMPEG(parent.input_path, "-", source_format, source_input_format)
         dec.start(stdout=subprocess.PIPE)
+        parent.register_process(dec)
         enc_input = "-"
         enc_stdin = dec.stdout
         enc_stderr = open(os.devnull, "w")
@@ -87,23 +149,38 @@ def encode(parent):
         enc_stderr = subprocess.PIPE
 
 
-    enc = FFMPEG(enc_input, parent.output_path, output_format, input_format)
+    if parent.settings.get("checksum", False):
+        output_format.append(["f", "tee"])
+        if parent.settings["container"] in ["mov", "mp4"]:
+            # tee does not tell encoders that the slave muxer needs extradata in global headers
+            output_format.append(["flags", "+global_header"])
+        enc_output = get_tee_output(parent)
+    else:
+        enc_output = parent.temp_output_path
+
+    enc = FFMPEG(enc_input, enc_output, output_format, input_format)
     enc.start(stdin=enc_stdin, stderr=enc_stderr)
+    parent.register_process(enc)
 
     if encode_method == "reclock":
         dec.stdout.close()
         while dec.is_running or enc.is_running:
             if dec.is_running:
-                dec.process(progress_handler=lambda x: parent.progress_handler(float(x) / parent.meta["num_frames"] * 100))
+                dec.process(progress_handler=progress_handler)
             if enc.is_running:
                 enc.process()
 
         if dec.return_code or enc.return_code:
                 logging.error("Decoding failed with following error:\n\n{}\n\n".format(indent(dec.error_log)))
                 logging.error("Encoding failed with following error:\n\n{}\n\n".format(indent(enc.error_log)))
+                return False
 
     else:
         while enc.is_running:
-            enc.process(progress_handler=lambda x: parent.progress_handler(float(x) / parent.meta["num_frames"] * 100))
+            enc.process(progress_handler=progress_handler)
+
+        if enc.return_code:
+            logging.error("Encoding failed with following error:\n\n{}\n\n".format(indent(enc.error_log)))
+            return False
 
     return True
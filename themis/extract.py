@@ -23,10 +23,11 @@ def extract(parent):
     if parent["crop_detect"]:
         filters.append("cropdetect")
 
-    cmd = [
-            "ffmpeg",
-            "-i", parent.input_path,
-        ]
+    cmd = ["ffmpeg"]
+    for key, value in parent.input_options:
+        cmd.extend(["-{}".format(key), str(value)])
+    cmd.extend(["-i", parent.input_path])
+
     if filters:
         cmd.extend([
             "-map", "0:{}".format(parent.meta["video_index"]),
@@ -51,6 +52,7 @@ def extract(parent):
     st = time.time()
     logging.debug("Executing: {}".format(" ".join(cmd)))
     proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+    parent.register_process(proc)
     while proc.poll() == None:
         try:
             ch = decode_if_py3(proc.stderr.read(1))
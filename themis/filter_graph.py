@@ -0,0 +1,135 @@
+import subprocess
+
+from nxtools import *
+from nxtools.media import *
+
+__all__ = ["FilterGraph", "build_filter_graph"]
+
+
+# Relative per-pixel cost of deinterlacers. bwdif gives better quality,
+# yadif is used when bwdif would be too slow for the source pixel rate.
+DEINTERLACER_COSTS = {
+        "yadif" : 1.0,
+        "bwdif" : 1.5,
+    }
+
+available_filters = None
+
+
+def get_available_filters():
+    global available_filters
+    if available_filters is None:
+        available_filters = []
+        try:
+            output = decode_if_py3(subprocess.check_output(
+                    ["ffmpeg", "-hide_banner", "-filters"],
+                    stderr=subprocess.STDOUT
+                ))
+            for line in output.split("\n"):
+                line = line.split()
+                if len(line) > 2:
+                    available_filters.append(line[1])
+        except Exception:
+            logging.warning("Unable to get list of available ffmpeg filters")
+    return available_filters
+
+
+
+class FilterGraph(object):
+    """Linear video filter chain with an explanation of each stage"""
+    def __init__(self):
+        self.stages = []
+
+    def __str__(self):
+        return ",".join([stage for name, stage, reason in self.stages]) or "null"
+
+    def __len__(self):
+        return len(self.stages)
+
+    def add(self, name, stage, reason):
+        self.stages.append((name, stage, reason))
+
+    def describe(self):
+        if not self.stages:
+            return "null (source matches output format)"
+        return "\n".join(["{}: {} ({})".format(*stage) for stage in self.stages])
+
+
+
+def get_deinterlacer(parent):
+    deinterlacer = parent.settings.get("deinterlacer", "auto")
+    if deinterlacer != "auto":
+        return deinterlacer
+    if "bwdif" not in get_available_filters():
+        return "yadif"
+    pixel_rate = parent.meta["width"] * parent.meta["height"] * parent.meta["frame_rate"]
+    if pixel_rate * DEINTERLACER_COSTS["bwdif"] > parent.settings["deinterlace_budget"]:
+        return "yadif"
+    return "bwdif"
+
+
+def get_scaler_flags(parent):
+    flags = parent.settings.get("scaler_flags", "auto")
+    if flags != "auto":
+        return flags
+    if parent.settings["width"] * parent.settings["height"] > parent.meta["width"] * parent.meta["height"]:
+        return "lanczos"
+    return "bicubic"
+
+
+def get_arc(width, height, aspect_ratio, flags):
+    """
+    Returns scale and pad filters, which fit the picture with aspect_ratio
+    to width x height frame (letterbox or pillarbox).
+    """
+    if aspect_ratio > float(width) / height:
+        scale_width, scale_height = width, int(round(width / aspect_ratio / 2)) * 2
+    else:
+        scale_width, scale_height = int(round(height * aspect_ratio / 2)) * 2, height
+    return "scale={}:{}:flags={},pad={}:{}:{}:{}:black".format(
+            scale_width, scale_height, flags,
+            width, height,
+            (width - scale_width) // 2, (height - scale_height) // 2
+        )
+
+
+def build_filter_graph(parent):
+    """
+    Builds the video filter chain with as few conversions as possible.
+
+    - deinterlacing is done first (in the source pixel format, which is usually smaller)
+    - scaling is skipped if the source already matches target size and aspect ratio
+    - output pixel format is fused with the scaler, so only one swscale conversion is done
+      and the -pix_fmt of the output profile is a no-op
+    """
+    graph = FilterGraph()
+    meta = parent.meta
+    settings = parent.settings
+    width, height = settings["width"], settings["height"]
+    pixel_format = settings["pixel_format"]
+
+    if settings["deinterlace"] and meta.get("is_interlaced", False):
+        deinterlacer = get_deinterlacer(parent)
+        graph.add("deinterlace", "{}=0:-1:0".format(deinterlacer), "source is interlaced")
+
+    same_size = meta["width"] == width and meta["height"] == height
+    same_aspect = abs(meta["aspect_ratio"] - float(width) / height) < 0.01
+    same_format = meta["pixel_format"] == pixel_format
+
+    if same_size and same_aspect:
+        if not same_format:
+            graph.add("format", "format={}".format(pixel_format), "{} to {}".format(meta["pixel_format"], pixel_format))
+        return graph
+
+    flags = get_scaler_flags(parent)
+    if same_aspect:
+        graph.add("scale", "scale={}:{}:flags={}".format(width, height, flags), "{}x{} to {}x{}".format(
+                meta["width"], meta["height"], width, height
+            ))
+    else:
+        arc = get_arc(width, height, meta["aspect_ratio"], flags)
+        graph.add("scale", arc, "aspect ratio {:.2f} to {:.2f}".format(
+                meta["aspect_ratio"], float(width) / height
+            ))
+    graph.add("format", "format={}".format(pixel_format), "fused with scale")
+    return graph
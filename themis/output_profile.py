@@ -1,6 +1,6 @@
 from nxtools import *
 
-__all__ = ["get_output_profile"]
+__all__ = ["get_output_profile", "get_container_options"]
 
 
 default_bitrates = {
@@ -22,6 +22,20 @@ default_audio_codecs = {
     }
 
 
+def get_container_options(**kwargs):
+    """Muxer private options. These must go to the tee slave when checksumming"""
+    result = []
+    if kwargs["container"] == "mov" and kwargs["frame_rate"] == 25:
+        result.append(["video_track_timescale", 25])
+    if kwargs.get("growing", False) and kwargs["container"] in ["mov", "mp4"]:
+        # Fragmented output is readable while it is being written.
+        # Fragments are cut by duration only: with frag_keyframe, intra-only codecs
+        # would get one fragment per frame and frag_duration would be ignored
+        result.append(["movflags", "+empty_moov+default_base_moof"])
+        result.append(["frag_duration", int(kwargs.get("fragment_duration", 2) * 1000000)])
+    return result
+
+
 def get_output_profile(**kwargs):
 
     #
@@ -73,7 +87,7 @@ def get_output_profile(**kwargs):
     result.append(["async", 2000])
     result.append(["map_metadata", "-1"])
 
-    if kwargs["container"] == "mov" and kwargs["frame_rate"] == 25:
-        result.append(["video_track_timescale", 25])
+    if not kwargs.get("checksum", False):
+        result.extend(get_container_options(**kwargs))
 
     return result
@@ -0,0 +1,138 @@
+import os
+import time
+import sqlite3
+import threading
+
+from nxtools import *
+
+__all__ = ["ScanIndex"]
+
+
+class ScanIndex(object):
+    """
+    Persistent index of files seen in a watchfolder.
+
+    Stores path, size, mtime, status and failure reason of each file,
+    so the watchfolder does not need to process its whole backlog again
+    after restart. Statuses are:
+
+        new      - seen, not processed yet
+        queued   - submitted for processing
+        done     - processed successfully (or skipped)
+        failed   - processing failed (see reason)
+
+    Files which changed since they were processed are reset to new.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                status TEXT,
+                reason TEXT,
+                updated REAL
+            )""")
+        # Jobs interrupted by restart
+        self.db.execute("UPDATE files SET status='new' WHERE status='queued'")
+        self.db.commit()
+        self.files = {}
+        for path, size, mtime, status in self.db.execute("SELECT path, size, mtime, status FROM files"):
+            self.files[path] = [size, mtime, status]
+
+    def __getitem__(self, path):
+        return self.files[path]
+
+    def __contains__(self, path):
+        return path in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+
+    def walk(self, root, exts=[], recursive=True):
+        """Yields DirEntry objects of matching files"""
+        exts = [ext.lower() for ext in exts]
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            logging.warning("Unable to scan {}".format(root))
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    for sub_entry in self.walk(entry.path, exts, recursive):
+                        yield sub_entry
+            elif entry.is_file():
+                if exts and os.path.splitext(entry.name)[1].lstrip(".").lower() not in exts:
+                    continue
+                yield entry
+
+
+    def scan(self, root, exts=[], recursive=True, settle=True):
+        """
+        Updates the index and returns list of paths ready for processing.
+        With settle=True, new files are returned only once their size and mtime
+        did not change since the previous scan.
+        """
+        result = []
+        changes = []
+        seen = set()
+        now = time.time()
+        for entry in self.walk(root, exts, recursive):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            path = entry.path
+            seen.add(path)
+            record = self.files.get(path)
+            if record is not None and record[2] == "queued":
+                # Files in progress may still grow in follow mode
+                if record[0] != stat.st_size or record[1] != stat.st_mtime:
+                    self.files[path] = [stat.st_size, stat.st_mtime, "queued"]
+                    changes.append((path, stat.st_size, stat.st_mtime, "queued", None, now))
+                continue
+            if record is None or record[0] != stat.st_size or record[1] != stat.st_mtime:
+                self.files[path] = [stat.st_size, stat.st_mtime, "new"]
+                changes.append((path, stat.st_size, stat.st_mtime, "new", None, now))
+                if settle:
+                    continue
+            elif record[2] != "new":
+                continue
+            if stat.st_size:
+                result.append(path)
+
+        removed = [path for path in self.files if path.startswith(root) and path not in seen]
+        for path in removed:
+            del self.files[path]
+
+        if changes or removed:
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", changes)
+                self.db.executemany("DELETE FROM files WHERE path=?", [(path,) for path in removed])
+                self.db.commit()
+        return result
+
+
+    def set_status(self, path, status, reason=None):
+        if path not in self.files:
+            return
+        self.files[path][2] = status
+        with self.lock:
+            self.db.execute(
+                    "UPDATE files SET status=?, reason=?, updated=? WHERE path=?",
+                    [status, reason, time.time(), path]
+                )
+            self.db.commit()
+
+    def get_reason(self, path):
+        with self.lock:
+            for reason, in self.db.execute("SELECT reason FROM files WHERE path=?", [path]):
+                return reason
+        return None
@@ -0,0 +1,317 @@
+import time
+import heapq
+import itertools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from nxtools import *
+
+from .themis import Themis
+
+__all__ = ["Job", "Scheduler", "PipelineScheduler"]
+
+
+class Job(object):
+    """
+    Single transcoding job.
+
+    Jobs are ordered by priority (higher first), then by expected processing
+    time (shortest job first), then by submission order. Expected processing
+    time is predicted by the cost model if available, source duration is used
+    otherwise.
+    """
+    _seq = itertools.count()
+
+    def __init__(self, transcoder, priority=0, **kwargs):
+        self.transcoder = transcoder
+        self.priority = priority
+        self.settings = kwargs
+        self.seq = next(self._seq)
+        self.submit_time = time.time()
+        self.result = None
+        self._expected_time = None
+
+    def __lt__(self, other):
+        return self.sort_key < other.sort_key
+
+    def __repr__(self):
+        return "Job ({}, priority {})".format(self.friendly_name, self.priority)
+
+    @property
+    def sort_key(self):
+        return (-self.priority, self.expected_time, self.seq)
+
+    @property
+    def duration(self):
+        return self.transcoder.duration
+
+    @property
+    def expected_time(self):
+        if self._expected_time is None:
+            predicted_time = self.transcoder.predicted_time
+            self._expected_time = self.duration if predicted_time is None else predicted_time
+        return self._expected_time
+
+    @property
+    def remaining_time(self):
+        eta = self.transcoder.eta
+        return self.expected_time if eta is None else eta
+
+    @property
+    def input_path(self):
+        return self.transcoder.input_path
+
+    @property
+    def friendly_name(self):
+        return self.transcoder.friendly_name
+
+    @property
+    def is_paused(self):
+        return self.transcoder.is_paused
+
+
+
+class Scheduler(object):
+    """
+    Runs jobs in priority lanes with up to `workers` concurrent jobs.
+
+    When `preempt` is enabled and a job with higher priority is queued while
+    all workers are busy, the lowest priority running job is paused (its child
+    processes are stopped) until a worker becomes free again.
+    """
+    def __init__(self, **kwargs):
+        self.settings = self.defaults
+        self.settings.update(kwargs)
+        self.queue = []
+        self.running = []
+        self.condition = threading.Condition()
+        self.should_run = True
+        self.probe_pool = ThreadPoolExecutor(max_workers=self["probe_workers"])
+
+    def __getitem__(self, key):
+        return self.settings[key]
+
+    @property
+    def defaults(self):
+        return {
+            "workers" : 1,
+            "preempt" : True,
+            "transcoder_class" : Themis,
+            "on_finished" : False,     # Callback (job, result) called when a job ends
+            "cost_model" : False,      # CostModel instance used for ordering and ETAs
+            "probe_workers" : 8,       # Number of threads probing files submitted using submit_async
+            "admission" : False,       # AdmissionController instance limiting concurrent jobs by resources
+            "admission_interval" : 5,  # Seconds between admission retries
+        }
+
+    @property
+    def active_jobs(self):
+        return [job for job in self.running if not job.is_paused]
+
+    @property
+    def paused_jobs(self):
+        """Paused jobs ordered by priority, then by remaining time"""
+        return sorted(
+                [job for job in self.running if job.is_paused],
+                key=lambda job: (-job.priority, job.remaining_time, job.seq)
+            )
+
+
+    @property
+    def backlog_time(self):
+        """
+        Estimated time (seconds) to finish all queued and running jobs
+        with the current number of workers. Used for capacity planning.
+        """
+        with self.condition:
+            total = sum([job.expected_time for job in self.queue])
+            total += sum([job.remaining_time for job in self.running])
+        return total / float(self.capacity)
+
+    @property
+    def capacity(self):
+        """Number of jobs processed at once"""
+        return self["workers"]
+
+
+    def submit(self, input_path, priority=0, **kwargs):
+        """Probes the source file and queues a new job. Returns the job or False"""
+        # Job settings must be known before the start, so they are part of the cost key
+        transcoder = self["transcoder_class"](input_path, cost_model=self["cost_model"], **kwargs)
+        if not transcoder:
+            return False
+        job = Job(transcoder, priority=priority, **kwargs)
+        with self.condition:
+            heapq.heappush(self.queue, job)
+            self.condition.notify()
+        logging.debug("Queued {}".format(job))
+        return job
+
+
+    def submit_async(self, input_path, priority=0, **kwargs):
+        """Same as submit, but probes the file in the probe pool. Returns Future"""
+        return self.probe_pool.submit(self.submit, input_path, priority=priority, **kwargs)
+
+
+    def start(self):
+        thread = threading.Thread(target=self.main)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.probe_pool.shutdown(wait=False)
+        with self.condition:
+            self.should_run = False
+            self.condition.notify()
+
+
+    def main(self):
+        # Host resources may be freed without notification, so admission is retried periodically
+        timeout = self["admission_interval"] if self["admission"] else None
+        with self.condition:
+            while self.should_run:
+                if not self.dispatch():
+                    self.condition.wait(timeout)
+
+    def can_admit(self, job):
+        return not self["admission"] or self["admission"].can_admit(job.transcoder)
+
+    def admit(self, job):
+        if self["admission"]:
+            self["admission"].admit(job.transcoder)
+
+    def release(self, job):
+        if self["admission"]:
+            self["admission"].release(job.transcoder)
+
+    def dispatch(self):
+        """Runs one scheduling step. Must be called with condition held"""
+        if len(self.active_jobs) < self["workers"]:
+            paused_jobs = self.paused_jobs
+            # Paused jobs already did part of their work, so they go before
+            # queued jobs of the same priority
+            if paused_jobs and (not self.queue or self.queue[0].priority <= paused_jobs[0].priority):
+                paused_jobs[0].transcoder.resume()
+                return True
+            if self.queue and self.can_admit(self.queue[0]):
+                self.run(heapq.heappop(self.queue))
+                return True
+            return False
+
+        if self["preempt"] and self.queue:
+            victim = max(self.active_jobs, key=lambda job: job.sort_key)
+            if self.queue[0].priority > victim.priority and self.can_admit(self.queue[0]):
+                logging.info("Preempting {} by {}".format(victim, self.queue[0]))
+                victim.transcoder.pause()
+                self.run(heapq.heappop(self.queue))
+                return True
+        return False
+
+    def run(self, job):
+        self.admit(job)
+        self.running.append(job)
+        thread = threading.Thread(target=self.worker, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def worker(self, job):
+        try:
+            job.result = job.transcoder.start(**job.settings)
+        except Exception:
+            log_traceback("Unhandled exception in {}".format(job))
+            job.result = False
+        with self.condition:
+            self.running.remove(job)
+            self.release(job)
+            self.condition.notify()
+        if self["on_finished"]:
+            self["on_finished"](job, job.result)
+
+
+
+class PipelineScheduler(Scheduler):
+    """
+    Runs processing stages of the transcoder (see BaseTranscoder.stages,
+    e.g. analyze and transcode) in separate worker pools, so the next job
+    can be analyzed while the current one is being encoded.
+
+    Jobs waiting for the next stage are kept in bounded priority queues
+    (`queue_size`). A stage does not start a new job while the queue of
+    the following stage is full, so analysis does not run too far ahead
+    and fill the scratch space. Jobs still running in a stage are not
+    counted, so up to stage workers + `queue_size` jobs may be ahead of
+    the following stage. Preemption is not supported.
+    """
+    def __init__(self, **kwargs):
+        super(PipelineScheduler, self).__init__(**kwargs)
+        self.stages = self["transcoder_class"].stages
+        self.stage_queues = [self.queue] + [[] for stage in self.stages[1:]]
+        self.stage_running = [0 for stage in self.stages]
+
+    @property
+    def defaults(self):
+        settings = super(PipelineScheduler, self).defaults
+        settings.update({
+            "stage_workers" : {},      # Number of workers per stage name (default 1)
+            "queue_size" : 1,          # Maximum number of jobs waiting for each stage but the first
+        })
+        return settings
+
+    @property
+    def capacity(self):
+        # Throughput of the pipeline is limited by its narrowest stage
+        return min([self.get_stage_workers(i) for i in range(len(self.stages))])
+
+    def get_stage_workers(self, i):
+        return self["stage_workers"].get(self.stages[i], 1)
+
+    def dispatch(self):
+        """Runs one scheduling step. Must be called with condition held"""
+        # Later stages go first, so finished jobs leave the pipeline as soon as possible
+        for i in reversed(range(len(self.stages))):
+            if not self.stage_queues[i]:
+                continue
+            if self.stage_running[i] >= self.get_stage_workers(i):
+                continue
+            if i < len(self.stages) - 1 and len(self.stage_queues[i+1]) >= self["queue_size"]:
+                continue
+            if i == 0 and not self.can_admit(self.stage_queues[0][0]):
+                continue
+            self.run_stage(heapq.heappop(self.stage_queues[i]), i)
+            return True
+        return False
+
+    def run_stage(self, job, i):
+        if i == 0:
+            self.admit(job)
+            self.running.append(job)
+        self.stage_running[i] += 1
+        thread = threading.Thread(target=self.stage_worker, args=(job, i))
+        thread.daemon = True
+        thread.start()
+
+    def stage_worker(self, job, i):
+        try:
+            if i == 0:
+                job.transcoder.begin(**job.settings)
+            result = job.transcoder.run_stage(self.stages[i])
+        except Exception:
+            log_traceback("Unhandled exception in {}".format(job))
+            result = False
+
+        is_finished = not result or i == len(self.stages) - 1
+        with self.condition:
+            self.stage_running[i] -= 1
+            if is_finished:
+                self.running.remove(job)
+                self.release(job)
+            else:
+                heapq.heappush(self.stage_queues[i+1], job)
+            self.condition.notify()
+
+        if is_finished:
+            job.result = job.transcoder.finish(result)
+            if self["on_finished"]:
+                self["on_finished"](job, job.result)
@@ -0,0 +1,27 @@
+import os
+import json
+
+__all__ = ["enable_simulator", "create_source"]
+
+bin_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin")
+
+
+def enable_simulator(speed=10, fail_rate=0, interlaced=False):
+    """
+    Makes themis (and all child processes) use fake ffmpeg, ffprobe and sox
+    by prepending simulator bin directory to PATH. See fake.py for details.
+    """
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["THEMIS_SIM_SPEED"] = str(speed)
+    os.environ["THEMIS_SIM_FAIL_RATE"] = str(fail_rate)
+    os.environ["THEMIS_SIM_INTERLACED"] = "1" if interlaced else "0"
+
+
+def create_source(path, **kwargs):
+    """
+    Creates simulated source file. Keyword arguments override
+    media properties (duration, frame_rate, width, height, pix_fmt,
+    video_codec, audio_tracks, channels, tags)
+    """
+    with open(path, "w") as f:
+        json.dump(kwargs, f)
@@ -0,0 +1,342 @@
+"""
+Fake ffmpeg, ffprobe and sox used for load testing.
+
+These mimic command line, stderr progress output, timing and exit codes
+of the real tools, but do not process any media. Simulated source files
+are small JSON files describing the media (see themis.simulator.create_source).
+Any other file is treated as a media file with default properties.
+
+Behaviour is configured using environment variables:
+
+    THEMIS_SIM_SPEED      processing speed (x realtime), default 10
+    THEMIS_SIM_FAIL_RATE  probability (0-1) a process fails in the middle, default 0
+    THEMIS_SIM_INTERLACED 1 to report interlaced content from idet filter
+
+Audio files are WAV headers with nominal length and no samples.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import struct
+
+DEFAULT_MEDIA = {
+        "duration" : 60.0,
+        "frame_rate" : "25/1",
+        "width" : 1920,
+        "height" : 1080,
+        "pix_fmt" : "yuv422p",
+        "video_codec" : "h264",
+        "audio_tracks" : 1,
+        "channels" : 2,
+    }
+
+# Filters reported by ffmpeg -filters (flags, name, pads, description)
+FILTERS = [
+        ("T.C", "bwdif", "V->V", "Deinterlace the input image."),
+        ("T.C", "yadif", "V->V", "Deinterlace the input image."),
+        ("...", "idet", "V->V", "Interlace detect Filter."),
+        ("...", "cropdetect", "V->V", "Auto-detect crop size."),
+        ("..C", "scale", "V->V", "Scale the input video size and/or convert the image format."),
+        ("..C", "pad", "V->V", "Pad the input video."),
+        ("...", "format", "V->V", "Convert the input video to one of the specified pixel formats."),
+        ("...", "apad", "A->A", "Pad audio with silence."),
+        ("...", "null", "V->V", "Pass the source unchanged to the output."),
+    ]
+
+# ffmpeg options which do not take a value
+FFMPEG_FLAGS = [
+        "-y", "-n", "-an", "-vn", "-sn", "-dn", "-shortest", "-hide_banner",
+        "-nostdin", "-stats", "-nostats", "-re"
+    ]
+
+
+def get_speed():
+    return float(os.environ.get("THEMIS_SIM_SPEED", 10))
+
+
+def should_fail():
+    return random.random() < float(os.environ.get("THEMIS_SIM_FAIL_RATE", 0))
+
+
+def load_media(path):
+    media = dict(DEFAULT_MEDIA)
+    try:
+        with open(path) as f:
+            media.update(json.load(f))
+    except Exception:
+        pass
+    return media
+
+
+def write_wav(path, duration=0, channels=2, sample_rate=48000):
+    """
+    Writes 16bit PCM WAV header. The data chunk declares nominal length
+    of the audio, but samples are not stored (reading them gives no data).
+    """
+    data_size = min(int(duration * sample_rate) * channels * 2, 0xFFFFFFFF - 36)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sI4s", b"RIFF", 36 + data_size, b"WAVE"))
+        f.write(struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, channels, sample_rate,
+                sample_rate * channels * 2, channels * 2, 16))
+        f.write(struct.pack("<4sI", b"data", data_size))
+
+
+def get_wav_duration(path):
+    with open(path, "rb") as f:
+        header = f.read(44)
+    channels, sample_rate = struct.unpack("<HI", header[22:28])
+    data_size = struct.unpack("<I", header[40:44])[0]
+    return float(data_size) / (sample_rate * channels * 2)
+
+
+def write_media(path, media):
+    with open(path, "w") as f:
+        json.dump(media, f)
+
+
+def simulate_progress(duration, line_handler, interval=.25):
+    """Calls line_handler(position) until duration is processed. Returns False on simulated failure"""
+    speed = get_speed()
+    fail_at = random.uniform(0, duration) if should_fail() else None
+    start_time = time.time()
+    while True:
+        position = min(duration, (time.time() - start_time) * speed)
+        if fail_at is not None and position >= fail_at:
+            return False
+        sys.stderr.write(line_handler(position))
+        sys.stderr.flush()
+        if position >= duration:
+            return True
+        time.sleep(interval)
+
+
+def format_time(seconds):
+    h, m, s = int(seconds // 3600), int(seconds // 60 % 60), seconds % 60
+    return "{:02d}:{:02d}:{:05.2f}".format(h, m, s)
+
+
+#
+# ffprobe
+#
+
+def ffprobe(args):
+    path = args[-1]
+    if not os.path.exists(path):
+        sys.stderr.write("{}: No such file or directory\n".format(path))
+        return 1
+    media = load_media(path)
+    fps_n, fps_d = [float(e) for e in media["frame_rate"].split("/")]
+    streams = [{
+            "index" : 0,
+            "codec_type" : "video",
+            "codec_name" : media["video_codec"],
+            "r_frame_rate" : media["frame_rate"],
+            "width" : media["width"],
+            "height" : media["height"],
+            "pix_fmt" : media["pix_fmt"],
+            "field_order" : "tt" if os.environ.get("THEMIS_SIM_INTERLACED", "0") == "1" else "progressive",
+            "duration" : str(media["duration"]),
+            "nb_frames" : str(int(media["duration"] * fps_n / fps_d)),
+        }]
+    for i in range(media["audio_tracks"]):
+        streams.append({
+                "index" : i + 1,
+                "codec_type" : "audio",
+                "codec_name" : "pcm_s16le",
+                "channels" : media["channels"],
+                "channel_layout" : "stereo" if media["channels"] == 2 else "mono",
+                "sample_rate" : "48000",
+            })
+    result = {
+            "streams" : streams,
+            "format" : {
+                "filename" : path,
+                "nb_streams" : len(streams),
+                "duration" : str(media["duration"]),
+                "size" : str(os.path.getsize(path)),
+                "tags" : media.get("tags", {}),
+            }
+        }
+    sys.stdout.write(json.dumps(result, indent=4))
+    return 0
+
+
+#
+# ffmpeg
+#
+
+def parse_ffmpeg_args(args):
+    inputs = []
+    outputs = []
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in FFMPEG_FLAGS:
+            options[arg] = True
+        elif arg.startswith("-") and arg != "-":
+            value = args[i+1] if i+1 < len(args) else ""
+            if arg == "-i":
+                inputs.append((value, options))
+                options = {}
+            else:
+                options[arg] = value
+            i += 1
+        else:
+            outputs.append((arg, options))
+            options = {}
+        i += 1
+    return inputs, outputs
+
+
+def split_tee(spec):
+    """Splits tee output specification to slaves, unescaping backslashes and quotes"""
+    slaves = [""]
+    quoted = False
+    i = 0
+    while i < len(spec):
+        char = spec[i]
+        if char == "\\" and i + 1 < len(spec):
+            i += 1
+            slaves[-1] += spec[i]
+        elif char == "'":
+            quoted = not quoted
+        elif char == "|" and not quoted:
+            slaves.append("")
+        else:
+            slaves[-1] += char
+        i += 1
+    return slaves
+
+
+def ffmpeg_filters():
+    sys.stdout.write("Filters:\n  T.. = Timeline support\n  .S. = Slice threading\n  ..C = Command support\n")
+    sys.stdout.write("  A = Audio input/output\n  V = Video input/output\n  N = Dynamic number and/or type of input/output\n")
+    sys.stdout.write("  | = Source or sink filter\n")
+    for flags, name, pads, description in FILTERS:
+        sys.stdout.write(" {} {:<16} {:<10} {}\n".format(flags, name, pads, description))
+    return 0
+
+
+def ffmpeg(args):
+    if "-filters" in args:
+        return ffmpeg_filters()
+    inputs, outputs = parse_ffmpeg_args(args)
+    if not inputs or not outputs:
+        sys.stderr.write("At least one output file must be specified\n")
+        return 1
+
+    input_path, input_options = inputs[0]
+    if input_path == "-":
+        # Raw video from a simulated decoder. Consume stdin until it is closed.
+        # Decoder already took the processing time, so progress is not simulated again
+        media = dict(DEFAULT_MEDIA)
+        stdin = getattr(sys.stdin, "buffer", sys.stdin)
+        while stdin.read(65536):
+            pass
+    elif not os.path.exists(input_path):
+        sys.stderr.write("{}: No such file or directory\n".format(input_path))
+        return 1
+    else:
+        media = load_media(input_path)
+
+    duration = float(input_options.get("-t", media["duration"]))
+    for output_path, output_options in outputs:
+        if "-t" in output_options:
+            duration = min(duration, float(output_options["-t"]))
+    fps_n, fps_d = [float(e) for e in media["frame_rate"].split("/")]
+    fps = fps_n / fps_d
+
+    sys.stderr.write("ffmpeg version simulated\nInput #0, from '{}':\n".format(input_path))
+
+    def progress_line(position):
+        return "frame={:5d} fps={:.0f} q=-1.0 size=N/A time={} bitrate=N/A speed={:.2f}x    \r".format(
+                int(position * fps),
+                fps * get_speed(),
+                format_time(position),
+                get_speed()
+            )
+
+    if input_path != "-" and not simulate_progress(duration, progress_line):
+        sys.stderr.write("\nError while decoding stream #0:0: Invalid data found when processing input\n")
+        return 1
+    sys.stderr.write("\n")
+
+    for output_path, output_options in outputs:
+        if "idet" in output_options.get("-filter:v", ""):
+            neither = int(duration * fps)
+            top = 0
+            if os.environ.get("THEMIS_SIM_INTERLACED", "0") == "1":
+                neither, top = 0, neither
+            sys.stderr.write(
+                "[Parsed_idet_0 @ 0x0] Repeated Fields: Neither:{:6d} Top:{:6d} Bottom:     0\n".format(neither, top)
+                )
+
+        if output_options.get("-f") == "tee":
+            # [f=mov:opt=val]path|[f=hash:hash=md5]path
+            targets = [target.lstrip("[").split("]", 1) for target in split_tee(output_path)]
+        else:
+            targets = [("f={}".format(output_options.get("-f", "")), output_path)]
+
+        for target_options, target in targets:
+            if target in ["-", os.devnull] or "f=null" in target_options.split(":"):
+                continue
+            if "f=hash" in target_options.split(":"):
+                with open(target, "w") as f:
+                    f.write("MD5={:032x}\n".format(random.getrandbits(128)))
+            elif target.endswith(".wav"):
+                write_wav(target, duration, channels=int(output_options.get("-ac", media["channels"])))
+            else:
+                write_media(target, dict(media, duration=duration))
+    return 0
+
+
+#
+# sox
+#
+
+def sox(args):
+    # sox [global options] infile [format options] outfile [effects]
+    files = []
+    i = 0
+    while i < len(args):
+        if args[i] == "-S":
+            pass
+        elif args[i].startswith("-"):
+            i += 1
+        else:
+            files.append(args[i])
+        i += 1
+    input_path, output_path = files[:2]
+    if not os.path.exists(input_path):
+        sys.stderr.write("sox FAIL formats: can't open input file `{}'\n".format(input_path))
+        return 2
+    duration = get_wav_duration(input_path)
+    if "tempo" in files:
+        duration /= float(files[files.index("tempo") + 1])
+
+    def progress_line(position):
+        return "In:{:.2f}% {} [00:00:00.00] Out:{}     [      |      ]        Clip:0    \r".format(
+                position / duration * 100,
+                format_time(position),
+                int(position * 48000)
+            )
+
+    if not simulate_progress(duration, progress_line):
+        sys.stderr.write("\nsox FAIL sox: `{}' Input/output error\n".format(input_path))
+        return 2
+    sys.stderr.write("\nDone.\n")
+    write_wav(output_path, duration)
+    return 0
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    handler = {"ffmpeg" : ffmpeg, "ffprobe" : ffprobe, "sox" : sox}[name]
+    try:
+        return handler(sys.argv[1:])
+    except KeyboardInterrupt:
+        return 255
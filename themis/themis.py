@@ -1,4 +1,5 @@
 import os
+import json
 import time
 
 from nxtools import *
@@ -6,12 +7,16 @@ from nxtools import *
 from .base_transcoder import *
 from .output_profile import *
 from .extract import extract
-from .encode  import encode
+from .encode  import reclock_audio, encode
+from .audio_analysis import has_numpy, analyze_tracks
+from .filter_graph import build_filter_graph
 
 __all__ = ["Themis"]
 
 
 class Themis(BaseTranscoder):
+    stages = ["analyze", "transcode"]
+
     @property
     def defaults(self):
         return {
@@ -40,12 +45,32 @@ class Themis(BaseTranscoder):
             # Helpers
             "expand_levels" : False,  # Expand tv color levels to full
             "deinterlace"   : True,   # Enable smart deinterlace (slower)
+            "deinterlacer"  : "auto", # yadif, bwdif or auto (chosen by source pixel rate)
+            "deinterlace_budget" : 1920 * 1080 * 30 * 1.5, # Pixel rate (pixels/s) times deinterlacer cost. Auto uses bwdif up to 1080p30
+            "scaler_flags"  : "auto", # swscale flags or auto (lanczos for upscale, bicubic otherwise)
+            "filter_threads": False,  # Number of filter threads
             "crop_detect"   : False,  # Enable smart crop detection (slower)
             "loudness"      : False,  # Normalize audio (LUFS)
             "logo"          : False,  # Path to logo to burn in
 
             "strip_tracks"   : 2,    # 0 - keep all audio tracks, 1 - Keep only first track, 2 - Keep only first track or keep all if they are mono
+                                     # 3 - Drop silent and duplicate tracks (requires numpy)
+            "silence_threshold" : -60,   # dBFS. Used by strip_tracks=3
+            "silence_ratio"     : .99,   # Drop tracks with at least this share of silence
+            "duplicate_correlation" : .999, # Drop tracks correlating with a previous track at least this much
             "to_stereo"      : True, # Mixdown multichannel audio tracks to stereo
+            "checksum"       : False, # Hash algorithm (md5, sha256...) for stream hash of output packets computed during encoding
+            "nice"           : False, # Niceness of child processes (also sets idle io class)
+            "cost_model"     : False, # CostModel instance used for ETA and scheduling
+
+            # Growing files
+            "growing"           : False, # Write fragmented output, which is readable during encoding
+            "fragment_duration" : 2,     # Seconds
+            "ready_handler"     : False, # Callback (transcoder, playable_seconds, is_complete)
+
+            # Growing sources
+            "follow"         : False, # Start processing source files which are still being written
+            "follow_timeout" : 10,    # Source is considered complete if it does not grow for this many seconds
         }
 
 
@@ -54,26 +79,22 @@ class Themis(BaseTranscoder):
         if not self["strip_tracks"]:
             return False
         strip_tracks = self["strip_tracks"]
-        if list(set([ track["channels"] for track in self.audio_tracks])) == 1:
+        if strip_tracks == 3:
+            return False
+        if len(set([ track["channels"] for track in self.audio_tracks])) == 1:
             if strip_tracks == 2 and self.audio_tracks[0]["channels"] == 1:
                 return False
         return strip_tracks
 
 
+    @property
+    def filter_graph(self):
+        return build_filter_graph(self)
+
+
     @property
     def filters(self):
-        filters = []
-        if self.settings["deinterlace"] and self.meta["is_interlaced"]:
-            logging.debug("{}: Using deinterlace filter".format(self.friendly_name))
-            filters.append(filter_deinterlace())
-
-        filters.append(
-            filter_arc(self.settings["width"],
-                self.settings["height"],
-                self.meta["aspect_ratio"]
-                )
-            )
-        return join_filters(*filters)
+        return str(self.filter_graph)
 
 
     @property
@@ -85,26 +106,210 @@ class Themis(BaseTranscoder):
         return float(profile_fps) / source_fps
 
 
+    @property
+    def follows_source(self):
+        """
+        In follow mode, the encoder reads video and audio directly from the growing
+        source, so copying and encoding overlap. Reclocking needs extracted audio
+        of the complete source, so such jobs wait for the copy during analysis.
+        """
+        return bool(self["follow"]) and not self.reclock_ratio
+
+
+    @property
+    def encode_method(self):
+        if self.reclock_ratio:
+            return "reclock"
+        return "follow" if self.follows_source else "direct"
+
+
+    @property
+    def cost_key(self):
+        return {
+            "encode_method" : self.encode_method,
+            "resolution" : "{}x{}".format(self.meta["width"], self.meta["height"]),
+            "video_codec" : self.meta["video_codec"],
+            "frame_rate" : round(self.meta["frame_rate"], 2),
+            "output_profile" : "{}@{}x{}@{}".format(
+                    self.settings["video_codec"],
+                    self.settings["width"],
+                    self.settings["height"],
+                    self.settings["video_bitrate"] or "default"
+                )
+        }
+
+
     def process(self):
+        for stage in self.stages:
+            if not getattr(self, stage)():
+                return False
+        return True
+
+
+    def analyze(self):
+        """I/O heavy stage: audio extraction, analysis and reclocking"""
         logging.debug("{}: Has {} audio track(s)".format(self.friendly_name, len(self.audio_tracks)))
         if self.audio_tracks and self.strip_tracks:
             logging.debug("{}: Stripping audio tracks".format(self.friendly_name))
             self.meta["audio_tracks"] = [self.audio_tracks[0]]
 
+        if self.follows_source:
+            # Nothing is extracted, so interlacing is taken from the stream headers
+            if self["deinterlace"]:
+                self.meta["is_interlaced"] = self.meta.get("field_order") in ["tt", "bb", "tb", "bt"]
+            if self["strip_tracks"] == 3 and len(self.audio_tracks) > 1:
+                logging.info("{}: Audio tracks are not analyzed in follow mode".format(self.friendly_name))
+            return True
+
         self.meta.update(extract(self))
+        if self["follow"]:
+            # Extraction read the source until it stopped growing
+            self.update_duration()
+
+        if self["strip_tracks"] == 3 and len(self.audio_tracks) > 1:
+            self.strip_dead_tracks()
+
+        return reclock_audio(self)
+
+
+    def transcode(self):
+        """CPU heavy stage: video encoding"""
+        logging.debug("{}: Video filter graph:\n{}".format(self.friendly_name, indent(self.filter_graph.describe())))
+
+        if self.settings["growing"]:
+            # Output is written directly to its final location. The sidecar
+            # marks it incomplete until it is committed.
+            self.update_readiness(0)
 
         success = encode(self)
+        if success and self.follows_source:
+            self.update_duration()
 
         if not success:
+            for path in [self.temp_output_path, self.temp_checksum_path, self.ready_path]:
+                try:
+                    os.remove(path)
+                except:
+                    pass
+            return False
+
+        return self.commit_output()
+
+
+    def update_duration(self):
+        """Updates duration of the source, which was probed while it was still growing"""
+        meta = probe(self.input_path)
+        if meta:
+            self.meta["duration"] = meta["duration"]
+            self.meta["num_frames"] = meta["num_frames"]
+
+
+    def strip_dead_tracks(self):
+        """Removes silent tracks and duplicates of previous tracks using extracted audio"""
+        if not has_numpy:
+            logging.warning("{}: numpy is not installed. Keeping all audio tracks".format(self.friendly_name))
+            return
+        self.set_status("Analyzing audio tracks")
+        try:
+            analysis = analyze_tracks(
+                    [track.source_audio_path for track in self.audio_tracks],
+                    silence_threshold=self["silence_threshold"]
+                )
+        except Exception:
+            log_traceback("Audio analysis failed. Keeping all audio tracks")
+            return
+
+        keep = []
+        for i, track in enumerate(self.audio_tracks):
+            track.analysis = analysis[i]
+            if analysis[i]["silence_ratio"] >= self["silence_ratio"]:
+                reason = "silent"
+            elif any(analysis[i]["correlation"][j] >= self["duplicate_correlation"] for j in keep):
+                reason = "duplicate"
+            else:
+                keep.append(i)
+                continue
+            logging.debug("{}: Dropping {} {} (rms {:.1f}dB, peak {:.1f}dB)".format(
+                    self.friendly_name, reason, track, analysis[i]["rms"], analysis[i]["peak"]
+                ))
+
+        if not keep:
+            # Output must have at least one audio track
+            keep = [0]
+
+        for i, track in enumerate(self.audio_tracks):
+            if i in keep:
+                continue
             try:
-                os.remove(self.output_path)
-            except:
+                os.remove(track.source_audio_path)
+            except Exception:
                 pass
+        self.meta["audio_tracks"] = [self.audio_tracks[i] for i in keep]
+
+
+    def commit_output(self):
+        """Atomically moves finished output (and its stream hash) to the final location"""
+        if self.settings["checksum"]:
+            try:
+                # hash muxer writes "ALGO=hexdigest"
+                checksum = open(self.temp_checksum_path).read().strip()
+                self.output_checksum = checksum.split("=", 1)[-1].lower()
+                os.rename(self.temp_checksum_path, self.checksum_path)
+            except Exception:
+                log_traceback("Unable to read output stream hash")
+                return False
+            logging.debug("{}: Output {} stream hash is {}".format(
+                    self.friendly_name,
+                    self.settings["checksum"],
+                    self.output_checksum
+                ))
+
+        try:
+            os.rename(self.temp_output_path, self.output_path)
+        except Exception:
+            log_traceback("Unable to move output file to its final location")
             return False
 
+        if self.settings["growing"]:
+            self.update_readiness(self.meta["duration"] / (self.reclock_ratio or 1), is_complete=True)
         return True
 
 
+    @property
+    def ready_path(self):
+        return self.output_path + ".ready"
+
+    def update_readiness(self, position, is_complete=False):
+        """
+        Reports how many seconds of the growing output are playable
+        using a sidecar JSON file and ready_handler callback.
+        Only completely written fragments are considered playable.
+        """
+        if is_complete:
+            playable = position
+        else:
+            fragment_duration = self.settings["fragment_duration"]
+            playable = max(0, (position // fragment_duration - 1) * fragment_duration)
+            if playable <= getattr(self, "playable", -1):
+                return
+        self.playable = playable
+
+        try:
+            temp_path = self.ready_path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump({
+                        "playable" : playable,
+                        "is_complete" : is_complete,
+                        "updated" : time.time()
+                    }, f)
+            os.rename(temp_path, self.ready_path)
+        except Exception:
+            log_traceback("Unable to write readiness file")
+
+        if self.settings["ready_handler"]:
+            self.settings["ready_handler"](self, playable, is_complete)
+
+
 
     def clean_up(self):
         return
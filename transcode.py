@@ -9,15 +9,106 @@
 import os
 import sys
 import json
+import shutil
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 from nxtools import *
 
-from themis import Themis
+from themis import Scheduler, PipelineScheduler, CostModel, AdmissionController
+from themis.scan_index import ScanIndex
+from themis.base_transcoder import get_temp_path
+from themis.simulator import enable_simulator
+
+
+class PostProcessor(threading.Thread):
+    """
+    Moves finished source files to the done directory in background,
+    so the encoder is free to start the next job.
+    """
+    def __init__(self, input_dir, done_dir):
+        super(PostProcessor, self).__init__()
+        self.daemon = True
+        self.input_dir = input_dir
+        self.done_dir = done_dir
+        self.queue = Queue()
+
+    def put(self, input_path):
+        self.queue.put(input_path)
+
+    def run(self):
+        while True:
+            input_path = self.queue.get()
+            try:
+                self.move_to_done(input_path)
+            except Exception:
+                log_traceback("Unable to move {} to done directory".format(input_path))
+            self.queue.task_done()
+
+    def move_to_done(self, input_path):
+        input_rel_path = input_path.replace(self.input_dir, "", 1).lstrip("/")
+        done_path = os.path.join(self.done_dir, input_rel_path)
+        done_dir = os.path.split(done_path)[0]
+        if not os.path.exists(done_dir):
+            os.makedirs(done_dir)
+        shutil.move(input_path, done_path)
+        logging.debug("Moved {} to {}".format(input_rel_path, self.done_dir))
+
 
 
 class ThemisWatchFolder(WatchFolder):
+    def __init__(self, input_dir, **kwargs):
+        super(ThemisWatchFolder, self).__init__(input_dir, **kwargs)
+        self.post_processor = False
+        if self.settings.get("done_dir", False):
+            self.post_processor = PostProcessor(self.input_dir, self.settings["done_dir"])
+            self.post_processor.start()
+        self.index = ScanIndex(self.settings.get("index_path", "themis-index.db"))
+        logging.info("Loaded scan index with {} files".format(len(self.index)))
+        scheduler_class = PipelineScheduler if self.settings.get("pipeline", False) else Scheduler
+        self.scheduler = scheduler_class(
+                workers=self.settings.get("workers", 1),
+                stage_workers=self.settings.get("stage_workers", {}),
+                probe_workers=self.settings.get("probe_workers", 8),
+                on_finished=self.on_finished,
+                cost_model=CostModel(self.settings.get("history_path", None)),
+                admission=AdmissionController(**self.settings["admission"]) if self.settings.get("admission", False) else False
+            )
+        self.scheduler.start()
+
+    def watch(self):
+        for input_path in self.index.scan(
+                    self.input_dir,
+                    exts=self.settings.get("exts", False) or self.settings.get("valid_exts", []),
+                    recursive=self.settings["recursive"],
+                    settle=not self.settings.get("follow", False)
+                ):
+            self.process(input_path)
+
+    def get_priority(self, input_rel_path):
+        """Priority of the job is given by its top-level subfolder"""
+        lane = input_rel_path.split("/")[0] if "/" in input_rel_path else ""
+        return self.settings.get("priorities", {}).get(lane, 0)
+
+    def is_incomplete(self, output_path):
+        """
+        Growing output is written directly to its final location, so output
+        of a job interrupted by restart exists, but its .ready sidecar
+        is not marked complete.
+        """
+        ready_path = output_path + ".ready"
+        if not os.path.exists(ready_path):
+            return False
+        try:
+            return not json.load(open(ready_path)).get("is_complete", False)
+        except Exception:
+            return True
+
     def process(self, input_path):
-        print input_path
         input_rel_path = input_path.replace(self.input_dir, "", 1).lstrip("/")
         input_base_name = get_base_name(input_rel_path)
 
@@ -28,22 +119,63 @@ class ThemisWatchFolder(WatchFolder):
                 os.makedirs(output_dir)
             except:
                 logging.error("Unable to create output directory {}".format(output_rel_dir))
-                self.ignore_files.add(input_path)
+                self.index.set_status(input_path, "failed", "Unable to create output directory")
                 return False
 
         output_path = os.path.join(output_dir, "{}.{}".format(input_base_name, "mov"))
         if os.path.exists(output_path):
-            return False
-
+            if not self.is_incomplete(output_path):
+                self.index.set_status(input_path, "done", "Output file exists")
+                return False
+            logging.warning("Removing incomplete output {}".format(output_path))
+            for path in [output_path, output_path + ".ready"]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        # Temporary files left by a job interrupted by restart
+        temp_path = get_temp_path(output_path)
+        for path in [temp_path, temp_path + ".streamhash", output_path + ".streamhash"]:
+            if os.path.exists(path):
+                logging.warning("Removing stale temporary file {}".format(path))
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        priority = self.get_priority(input_rel_path)
+        kwargs = {
+                "output_path" : output_path,
+                "video_bitrate" : "36M",
+                "checksum" : self.settings.get("checksum", False),
+                "growing" : self.settings.get("growing", False),
+                "follow" : self.settings.get("follow", False),
+            }
+        if priority < 0 and self.settings.get("nice", False):
+            kwargs["nice"] = self.settings["nice"]
+
+        self.index.set_status(input_path, "queued")
+        future = self.scheduler.submit_async(input_path, priority=priority, **kwargs)
+        future.add_done_callback(lambda f: self.on_submitted(input_path, f))
+        return True
+
+    def on_submitted(self, input_path, future):
         try:
-            themis = Themis(input_path)
-            themis.process(
-                    output_path=output_path,
-                    video_bitrate="36M"
-                )
+            job = future.result()
         except Exception:
-            log_traceback("Encoding failed")
-            self.ignore_files.add(input_path)
+            log_traceback("Unable to queue {}".format(input_path))
+            job = False
+        if not job:
+            self.index.set_status(input_path, "failed", "Unable to open file")
+
+    def on_finished(self, job, result):
+        if not result:
+            self.index.set_status(job.input_path, "failed", "Transcoding failed")
+            return
+        self.index.set_status(job.input_path, "done")
+        if self.post_processor:
+            self.post_processor.put(job.input_path)
 
 
 
@@ -52,6 +184,7 @@ class ThemisWatchFolder(WatchFolder):
 if __name__ == "__main__":
     settings_file = "settings.json"
 
+    cfg = {}
     if os.path.exists(settings_file):
         try:
             cfg = json.load(open(settings_file))
@@ -59,6 +192,10 @@ if __name__ == "__main__":
             log_traceback()
             cfg = {}
 
+    if cfg.get("simulate", False):
+        logging.warning("Using simulated ffmpeg, ffprobe and sox")
+        enable_simulator(**cfg["simulate"])
+
     valid_exts = ["mov", "mp4", "avi", "flv", "mpg", "mpeg", "mp4", "video", "m4v", "mts", "MTS", "MP4"]
 
     input_dir = cfg.get("input_dir", "input")
@@ -67,9 +204,21 @@ if __name__ == "__main__":
     watch = ThemisWatchFolder(
         input_dir=input_dir,
         output_dir=output_dir,
-        valid_exts=valid_exts
+        done_dir=cfg.get("done_dir", False),
+        checksum=cfg.get("checksum", False),
+        workers=cfg.get("workers", 1),
+        priorities=cfg.get("priorities", {}),
+        nice=cfg.get("nice", False),
+        history_path=cfg.get("history_path", None),
+        growing=cfg.get("growing", False),
+        follow=cfg.get("follow", False),
+        index_path=cfg.get("index_path", "themis-index.db"),
+        probe_workers=cfg.get("probe_workers", 8),
+        pipeline=cfg.get("pipeline", False),
+        stage_workers=cfg.get("stage_workers", {}),
+        admission=cfg.get("admission", False),
+        valid_exts=valid_exts,
+        recursive=cfg.get("recursive", True)
         )
 
     watch.start()
-
-